@@ -1,11 +1,30 @@
-from fastapi import APIRouter, FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi import APIRouter, FastAPI, Header, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+import asyncio
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+import hashlib
+import hmac
+import heapq
 import httpx
+import json
+import logging
+import logging.handlers
+import numpy as np
 import os
+import queue
+import random
+import re
+import time
+from urllib.parse import parse_qsl, urlencode
 from supabase import create_client
 from datetime import datetime, timedelta, date, timezone
 
 app = FastAPI()
+logger = logging.getLogger(__name__)
 
 # ============================
 #  CONFIG SUPABASE
@@ -17,6 +36,7 @@ if not SUPABASE_URL or not SUPABASE_SERVICE_ROLE_KEY:
     raise RuntimeError("SUPABASE_URL et SUPABASE_SERVICE_ROLE_KEY doivent être définies dans Render.")
 
 USERS_TABLE_URL = f"{SUPABASE_URL}/rest/v1/users"
+RADAR_TABLE_URL = f"{SUPABASE_URL}/rest/v1/user_radar"
 
 
 def supabase_headers(prefer_return: str = "return=minimal"):
@@ -29,6 +49,25 @@ def supabase_headers(prefer_return: str = "return=minimal"):
     }
 
 
+# compteur d'appels Supabase de la requête en cours (cf. TrafficCapture)
+upstream_calls: ContextVar[list[int] | None] = ContextVar("upstream_calls", default=None)
+
+
+def count_upstream_call_sync(request: httpx.Request):
+    counter = upstream_calls.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+async def count_upstream_call(request: httpx.Request):
+    count_upstream_call_sync(request)
+
+
+def supabase_client() -> httpx.AsyncClient:
+    """Client HTTP pour l'API REST Supabase (appels comptés par requête)."""
+    return httpx.AsyncClient(event_hooks={"request": [count_upstream_call]})
+
+
 # ============================
 #  MODELES Pydantic
 # ============================
@@ -53,6 +92,14 @@ class PackPurchase(BaseModel):
     quantity: int
 
 
+# les noms incertains partent dans une seule URL username=in.(...)
+USERNAME_BATCH_MAX = int(os.getenv("USERNAME_BATCH_MAX", "100"))
+
+
+class UsernameBatch(BaseModel):
+    usernames: list[str] = Field(max_length=USERNAME_BATCH_MAX)
+
+
 class SubscriptionUpdate(BaseModel):
     userId: str
     originalTransactionId: str
@@ -82,7 +129,7 @@ class RadarLevelStats(BaseModel):
 
 async def get_user(user_id: str):
     """Récupère un utilisateur par userId."""
-    async with httpx.AsyncClient() as client:
+    async with supabase_client() as client:
         resp = await client.get(
             USERS_TABLE_URL,
             params={"userId": f"eq.{user_id}", "select": "*"},
@@ -100,7 +147,7 @@ async def get_user(user_id: str):
 
 async def patch_user(user_id: str, fields: dict):
     """PATCH sur un utilisateur donné."""
-    async with httpx.AsyncClient() as client:
+    async with supabase_client() as client:
         resp = await client.patch(
             USERS_TABLE_URL,
             params={"userId": f"eq.{user_id}"},
@@ -112,6 +159,63 @@ async def patch_user(user_id: str, fields: dict):
         raise HTTPException(status_code=500, detail=f"Supabase patch error: {resp.text}")
 
 
+def postgrest_quote(value) -> str:
+    """Valeur utilisable dans un filtre PostgREST in.(...) / or=(...)."""
+    if not isinstance(value, str):
+        return str(value)
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def keyset_filter(keys: tuple[str, ...], last: tuple) -> str:
+    """
+    Filtre "après la ligne `last`" pour un tri asc sur `keys`.
+    ex: (userId, level) → (userId.gt.X,and(userId.eq.X,level.gt.Y))
+    """
+    clauses = []
+    for i, key in enumerate(keys):
+        conds = [f"{k}.eq.{postgrest_quote(v)}" for k, v in zip(keys[:i], last[:i])]
+        conds.append(f"{key}.gt.{postgrest_quote(last[i])}")
+        clauses.append(conds[0] if len(conds) == 1 else f"and({','.join(conds)})")
+    return f"({','.join(clauses)})"
+
+
+async def iter_keyset_pages(table_url: str, select: str, keys: tuple[str, ...],
+                            filters: dict | None = None, page_size: int = 1000):
+    """
+    Parcourt une table page par page, paginée par keyset sur `keys`
+    (jamais d'offset : coût constant quelle que soit la profondeur).
+    Les colonnes de `keys` doivent être dans `select`.
+    """
+    last = None
+    async with supabase_client() as client:
+        while True:
+            params = {
+                "select": select,
+                "order": ",".join(f"{k}.asc" for k in keys),
+                "limit": str(page_size),
+                **(filters or {}),
+            }
+            if last is not None:
+                params["or"] = keyset_filter(keys, last)
+            resp = await client.get(
+                table_url,
+                params=params,
+                headers=supabase_headers(prefer_return="return=representation"),
+                timeout=20.0,
+            )
+            if resp.status_code != 200:
+                # 400 PostgREST = colonne ou valeur de filtre invalide
+                status = 400 if resp.status_code == 400 else 500
+                raise HTTPException(status_code=status, detail=f"Supabase error: {resp.text}")
+
+            rows = resp.json()
+            if rows:
+                yield rows
+            if len(rows) < page_size:
+                return
+            last = tuple(rows[-1][k] for k in keys)
+
+
 def parse_ts(value):
     """
     Convertit un timestamp Supabase (ISO string ou datetime) en datetime UTC.
@@ -204,11 +308,18 @@ async def refresh_user_lives(user_id: str):
     Récupère l'utilisateur, applique update_lives,
     et sauvegarde les champs de vies dans Supabase.
     Retourne le dict utilisateur mis à jour.
+    En mode acteur, les vies viennent de l'acteur et ne sont pas
+    sauvegardées ici (checkpoint périodique).
     """
     user = await get_user(user_id)
     if not user:
         return None
 
+    if LIVES_ACTORS_ENABLED:
+        lives = await lives_actors.ask(user_id, lives_snapshot)
+        user.update(lives)
+        return user
+
     updated = update_lives(user)
 
     fields = {
@@ -223,6 +334,831 @@ async def refresh_user_lives(user_id: str):
     return updated
 
 
+# Les fonctions suivantes appliquent une action sur une ligne user déjà
+# passée par update_lives. Elles modifient la ligne et retournent
+# (champs à sauvegarder ou None, réponse pour l'app).
+
+def lives_snapshot(user: dict):
+    return None, {k: user.get(k) for k in LIVES_FIELDS + ("nextLifeInSeconds",)}
+
+
+def consume_life(user: dict):
+    subscription = user.get("subscriptionStatus", False)
+    natural = user.get("naturallives") or 0
+    max_lives = user.get("maxnaturallives") or 3
+    bought = user.get("boughtlives") or 0
+
+    # Abonné : pas de limite de vie (on ne consomme rien)
+    if subscription:
+        return None, {
+            "ok": True,
+            "naturalLives": natural,
+            "maxNaturalLives": max_lives,
+            "boughtLives": bought,
+            "premiumUnlimited": True,
+        }
+
+    # On consomme d'abord une vie naturelle, sinon une vie achetée
+    last_life_regen_at = user.get("lastliferegenat")
+    now_iso = datetime.utcnow().isoformat()
+
+    if natural > 0:
+        natural -= 1
+
+        # Si on vient de passer de plein -> pas plein, on arme un timer
+        if natural == max_lives - 1:
+            last_life_regen_at = now_iso
+
+    elif bought > 0:
+        bought -= 1
+    else:
+        raise HTTPException(status_code=400, detail="No lives left")
+
+    user["naturallives"] = natural
+    user["boughtlives"] = bought
+    user["lastliferegenat"] = last_life_regen_at
+
+    fields = {
+        "naturallives": natural,
+        "boughtlives": bought,
+        "lastliferegenat": last_life_regen_at,
+        "lastactivedate": now_iso,
+    }
+    return fields, {
+        "ok": True,
+        "naturalLives": natural,
+        "maxNaturalLives": max_lives,
+        "boughtLives": bought,
+        "premiumUnlimited": False,
+    }
+
+
+def reward_life(user: dict):
+    subscription = user.get("subscriptionStatus", False)
+    natural = user.get("naturallives") or 0
+    max_lives = user.get("maxnaturallives") or 3
+    bought = user.get("boughtlives") or 0
+
+    # compteur cumulatif
+    total_ads = user.get("rewardedAdsTotalCount") or 0
+
+    # Abonné : vies illimitées
+    if subscription:
+        return None, {
+            "ok": True,
+            "premiumUnlimited": True,
+            "naturalLives": natural,
+            "boughtLives": bought,
+            "rewardedAdsTotalCount": total_ads
+        }
+
+    # 🎁 Rewarded Ad = +1 vie achetée
+    bought += 1
+    total_ads += 1
+
+    user["boughtlives"] = bought
+    user["rewardedAdsTotalCount"] = total_ads
+
+    fields = {
+        "boughtlives": bought,
+        "rewardedAdsTotalCount": total_ads,
+        "lastactivedate": datetime.utcnow().isoformat(),
+    }
+    return fields, {
+        "ok": True,
+        "premiumUnlimited": False,
+        "naturalLives": natural,
+        "boughtLives": bought,
+        "rewardedAdsTotalCount": total_ads,
+        "maxNaturalLives": max_lives
+    }
+
+
+def purchase_lives(user: dict, payload: PackPurchase):
+    if payload.productId == "pytha.pack10":
+        amount = 10 * payload.quantity
+    elif payload.productId == "pytha.pack20":
+        amount = 20 * payload.quantity
+    else:
+        amount = 0
+
+    if amount <= 0:
+        return None, {"ok": True, "boughtLives": user.get("boughtlives") or 0}
+
+    bought = (user.get("boughtlives") or 0) + amount
+    user["boughtlives"] = bought
+
+    return {"boughtlives": bought}, {"ok": True, "boughtLives": bought}
+
+
+# ============================
+#  LIVES STREAM (SSE)
+# ============================
+LIVES_STREAM_KEEPALIVE_SECONDS = float(os.getenv("LIVES_STREAM_KEEPALIVE_SECONDS", "25"))
+
+
+def lives_payload(row: dict) -> dict:
+    """Etat des vies tel qu'envoyé à l'app (même clés que /consumePlay)."""
+    return {
+        "naturalLives": row.get("naturallives") or 0,
+        "maxNaturalLives": row.get("maxnaturallives") or 3,
+        "boughtLives": row.get("boughtlives") or 0,
+        "nextLifeInSeconds": row.get("nextLifeInSeconds") or 0,
+        "premiumUnlimited": bool(row.get("subscriptionStatus", False)),
+    }
+
+
+class LivesBroadcaster:
+    """
+    Pousse l'état des vies aux connexions SSE ouvertes.
+    Un seul timer pour tout le process : un heap (échéance, userId)
+    consommé par une tâche unique, pas de tâche par connexion.
+    Rien n'est écrit dans Supabase : la regen est recalculée en mémoire
+    avec update_lives sur la dernière ligne connue.
+    Propre au process : publish n'atteint que les connexions ouvertes sur
+    cette instance. Avec plusieurs instances, une écriture faite ailleurs
+    n'est vue qu'à la reconnexion du client.
+    """
+
+    def __init__(self):
+        self.subscribers: dict[str, set[asyncio.Queue]] = {}
+        self.rows: dict[str, dict] = {}
+        self.last_sent: dict[str, dict] = {}
+        self.heap: list[tuple[float, str]] = []
+        self.due: dict[str, float] = {}
+        self.wakeup = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def subscribe(self, user_id: str, row: dict) -> asyncio.Queue:
+        # maxsize=1 : seul le dernier état compte, une connexion lente
+        # ne fait jamais grossir la mémoire
+        queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+        self.subscribers.setdefault(user_id, set()).add(queue)
+        self.start()
+        self.last_sent.pop(user_id, None)
+        self.publish(user_id, row)
+        return queue
+
+    def unsubscribe(self, user_id: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(user_id)
+        if not queues:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self.subscribers[user_id]
+            self.rows.pop(user_id, None)
+            self.last_sent.pop(user_id, None)
+            # l'entrée du heap devient orpheline et sera ignorée
+            self.due.pop(user_id, None)
+
+    def publish(self, user_id: str, row: dict):
+        """
+        A appeler avec une ligne passée par update_lives
+        (nextLifeInSeconds à jour). No-op si personne n'écoute.
+        """
+        queues = self.subscribers.get(user_id)
+        if not queues:
+            return
+
+        self.rows[user_id] = dict(row)
+        payload = lives_payload(row)
+        if payload != self.last_sent.get(user_id):
+            self.last_sent[user_id] = payload
+            for queue in queues:
+                if queue.full():
+                    queue.get_nowait()
+                queue.put_nowait(payload)
+
+        self.schedule(user_id, row)
+
+    async def refresh(self, user_id: str):
+        """
+        Relit la ligne après une écriture qui ne passe pas par publish
+        (reset, abonnement, updateUser). No-op si personne n'écoute.
+        """
+        if user_id not in self.subscribers:
+            return
+        user = await get_user(user_id)
+        if user is None:
+            self.rows.pop(user_id, None)
+            self.due.pop(user_id, None)
+            return
+        self.publish(user_id, update_lives(user))
+
+    def schedule(self, user_id: str, row: dict):
+        if row.get("subscriptionStatus", False):
+            self.due.pop(user_id, None)
+            return
+        if (row.get("naturallives") or 0) >= (row.get("maxnaturallives") or 3):
+            self.due.pop(user_id, None)
+            return
+
+        # +1s : update_lives arrondit à la seconde inférieure
+        when = time.monotonic() + (row.get("nextLifeInSeconds") or 0) + 1
+        self.due[user_id] = when
+        heapq.heappush(self.heap, (when, user_id))
+        if self.heap[0] == (when, user_id):
+            self.wakeup.set()
+
+    async def run(self):
+        while True:
+            if not self.heap:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            when, user_id = self.heap[0]
+            delay = when - time.monotonic()
+            if delay > 0:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.heap)
+            if self.due.get(user_id) != when:
+                continue
+            del self.due[user_id]
+
+            row = self.rows.get(user_id)
+            if row is not None:
+                self.publish(user_id, update_lives(dict(row)))
+
+
+lives_broadcaster = LivesBroadcaster()
+
+
+# ============================
+#  USERNAME INDEX
+# ============================
+USERNAME_INDEX_REFRESH_SECONDS = float(os.getenv("USERNAME_INDEX_REFRESH_SECONDS", "300"))
+USERNAME_INDEX_PAGE_SIZE = 1000
+# USERNAME_INDEX_AUTHORITATIVE=1 : une seule instance écrit les users,
+# l'index peut donc répondre "libre" sans demander à Supabase
+USERNAME_INDEX_AUTHORITATIVE = os.getenv("USERNAME_INDEX_AUTHORITATIVE", "0") == "1"
+
+
+class UsernameIndex:
+    """
+    Index en mémoire des usernames pris, pour /checkUsername.
+    Chargé au démarrage puis rechargé périodiquement, et tenu à jour
+    par /initUser, /updateUser et /resetUser.
+
+    - username présent                       → pris
+    - absent, index frais et AUTHORITATIVE   → libre
+    - sinon                                  → on demande à Supabase
+
+    Sans USERNAME_INDEX_AUTHORITATIVE, d'autres instances peuvent créer
+    des users entre deux rechargements : un nom absent n'est pas sûr.
+    """
+
+    def __init__(self):
+        self.by_user: dict[str, str] = {}
+        self.counts: dict[str, int] = {}
+        self.loaded_at: float | None = None
+        # changements reçus pendant un rechargement, rejoués à la fin
+        self.pending: dict[str, str] | None = None
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def set(self, user_id: str, username: str | None):
+        if self.pending is not None:
+            self.pending[user_id] = username
+        self._set(user_id, username)
+
+    def _set(self, user_id: str, username: str | None):
+        old = self.by_user.pop(user_id, None)
+        if old is not None:
+            self.counts[old] -= 1
+            if not self.counts[old]:
+                del self.counts[old]
+        if username is not None:
+            self.by_user[user_id] = username
+            self.counts[username] = self.counts.get(username, 0) + 1
+
+    def is_fresh(self) -> bool:
+        return (
+            self.loaded_at is not None
+            and time.monotonic() - self.loaded_at < 2 * USERNAME_INDEX_REFRESH_SECONDS
+        )
+
+    def lookup(self, username: str) -> bool | None:
+        """True = disponible, False = pris, None = inconnu."""
+        if self.loaded_at is None:
+            return None
+        if username in self.counts:
+            return False
+        if USERNAME_INDEX_AUTHORITATIVE and self.is_fresh():
+            return True
+        return None
+
+    async def load(self):
+        """Recharge tout l'index en paginant sur userId (keyset)."""
+        self.pending = {}
+        by_user: dict[str, str] = {}
+        try:
+            pages = iter_keyset_pages(
+                USERS_TABLE_URL, "userId,username", ("userId",),
+                page_size=USERNAME_INDEX_PAGE_SIZE,
+            )
+            async for rows in pages:
+                for r in rows:
+                    if r.get("username") is not None:
+                        by_user[r["userId"]] = r["username"]
+
+            self.by_user = {}
+            self.counts = {}
+            for user_id, username in by_user.items():
+                self._set(user_id, username)
+            for user_id, username in self.pending.items():
+                self._set(user_id, username)
+            self.loaded_at = time.monotonic()
+        finally:
+            self.pending = None
+
+    async def run(self):
+        while True:
+            try:
+                await self.load()
+            except Exception:
+                logger.exception("Username index reload failed")
+            await asyncio.sleep(USERNAME_INDEX_REFRESH_SECONDS)
+
+
+username_index = UsernameIndex()
+
+
+async def fetch_taken_usernames(usernames: list[str]) -> set[str]:
+    """Demande à Supabase lesquels de ces usernames sont pris (une requête)."""
+    quoted = ",".join(postgrest_quote(u) for u in usernames)
+    async with supabase_client() as client:
+        resp = await client.get(
+            USERS_TABLE_URL,
+            params={"username": f"in.({quoted})", "select": "username"},
+            headers=supabase_headers(prefer_return="return=representation"),
+            timeout=10.0,
+        )
+
+    if resp.status_code != 200:
+        raise HTTPException(status_code=500, detail=f"Supabase error: {resp.text}")
+
+    return {r["username"] for r in resp.json()}
+
+
+async def check_usernames_available(usernames: list[str]) -> dict[str, bool]:
+    results: dict[str, bool] = {}
+    unsure: list[str] = []
+    for username in usernames:
+        available = username_index.lookup(username)
+        if available is None:
+            unsure.append(username)
+        else:
+            results[username] = available
+
+    if unsure:
+        taken = await fetch_taken_usernames(unsure)
+        for username in unsure:
+            results[username] = username not in taken
+
+    return results
+
+
+@app.on_event("startup")
+async def start_username_index():
+    username_index.start()
+
+
+# ============================
+#  IDEMPOTENCY
+# ============================
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "600"))
+IDEMPOTENCY_MAX_ENTRIES = int(os.getenv("IDEMPOTENCY_MAX_ENTRIES", "10000"))
+
+
+class IdempotencyCache:
+    """
+    Cache borné (taille + TTL) des réponses des routes qui créditent /
+    débitent des vies, indexé par (route, userId, Idempotency-Key).
+    Un retry renvoie la réponse stockée sans toucher Supabase ;
+    un retry qui arrive pendant la requête d'origine attend son résultat.
+    Les erreurs ne sont pas mises en cache (le retry rejoue).
+    Une clé réutilisée avec un autre body est refusée (422).
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # key -> (expiration, empreinte du body, réponse)
+        self.done: OrderedDict[tuple, tuple[float, str, dict]] = OrderedDict()
+        # key -> (future, empreinte du body)
+        self.inflight: dict[tuple, tuple[asyncio.Future, str]] = {}
+
+    def _expire(self):
+        now = time.monotonic()
+        while self.done:
+            expires_at = next(iter(self.done.values()))[0]
+            if expires_at > now:
+                break
+            self.done.popitem(last=False)
+
+    @staticmethod
+    def _check(fingerprint: str, stored: str):
+        if fingerprint != stored:
+            raise HTTPException(
+                status_code=422,
+                detail="Idempotency-Key already used with a different request body",
+            )
+
+    async def run(self, key: tuple, fingerprint: str, action):
+        """Exécute action() une seule fois par clé ; action renvoie la réponse."""
+        while True:
+            self._expire()
+            hit = self.done.get(key)
+            if hit is not None:
+                self._check(fingerprint, hit[1])
+                return hit[2]
+
+            inflight = self.inflight.get(key)
+            if inflight is None:
+                break
+            pending, stored = inflight
+            self._check(fingerprint, stored)
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                # requête d'origine annulée : on la rejoue nous-mêmes
+                if pending.cancelled():
+                    continue
+                raise
+
+        future = asyncio.get_running_loop().create_future()
+        self.inflight[key] = (future, fingerprint)
+        try:
+            result = await action()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as exc:
+            future.set_exception(exc)
+            # évite "Future exception was never retrieved" sans attente
+            future.exception()
+            raise
+        else:
+            self.done[key] = (time.monotonic() + self.ttl, fingerprint, result)
+            while len(self.done) > self.max_entries:
+                self.done.popitem(last=False)
+            future.set_result(result)
+            return result
+        finally:
+            self.inflight.pop(key, None)
+
+
+idempotency_cache = IdempotencyCache(IDEMPOTENCY_TTL_SECONDS, IDEMPOTENCY_MAX_ENTRIES)
+
+
+async def run_idempotent(route: str, payload: BaseModel, idempotency_key: str | None, action):
+    """Passe par le cache seulement si le client a envoyé un Idempotency-Key."""
+    if not idempotency_key:
+        return await action()
+    body = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":"))
+    fingerprint = hashlib.sha256(body.encode()).hexdigest()
+    key = (route, payload.userId, idempotency_key)
+    return await idempotency_cache.run(key, fingerprint, action)
+
+
+# ============================
+#  LIVES ACTORS (optionnel)
+# ============================
+# LIVES_ACTORS=1 : l'état des vies d'un joueur actif reste en mémoire dans
+# un acteur (une tâche + une mailbox) et n'est sauvegardé dans Supabase que
+# périodiquement et à l'éviction. Seuls /consumePlay, /rewarded et /getUser
+# passent par l'acteur ; les achats restent écrits immédiatement.
+# A n'activer qu'avec une seule instance (ou un routage par userId),
+# sinon deux acteurs divergent.
+LIVES_ACTORS_ENABLED = os.getenv("LIVES_ACTORS", "0") == "1"
+LIVES_ACTOR_CHECKPOINT_SECONDS = float(os.getenv("LIVES_ACTOR_CHECKPOINT_SECONDS", "10"))
+LIVES_ACTOR_IDLE_SECONDS = float(os.getenv("LIVES_ACTOR_IDLE_SECONDS", "120"))
+LIVES_ACTOR_MAX = int(os.getenv("LIVES_ACTOR_MAX", "5000"))
+# durée max du checkpoint final d'un acteur, puis les champs sont abandonnés (loggés)
+LIVES_ACTOR_FLUSH_SECONDS = float(os.getenv("LIVES_ACTOR_FLUSH_SECONDS", "10"))
+# attente max d'une route bloquée par un acteur en cours d'arrêt, puis 503
+LIVES_ACTOR_WAIT_SECONDS = float(os.getenv("LIVES_ACTOR_WAIT_SECONDS", "15"))
+# arrêt du process : tous les acteurs sont sauvegardés en parallèle,
+# dans la limite de ce délai (< délai de grâce de Render, 30s)
+LIVES_ACTORS_SHUTDOWN_SECONDS = float(os.getenv("LIVES_ACTORS_SHUTDOWN_SECONDS", "20"))
+
+# colonnes possédées par l'acteur (les seules qu'il sauvegarde)
+LIVES_FIELDS = (
+    "naturallives", "boughtlives", "lastliferegenat", "lastdailybonus", "rewardedAdsTotalCount",
+)
+
+_STOP = object()
+
+
+class LivesActor:
+    """
+    Acteur d'un joueur : les actions sont appliquées une par une, dans
+    l'ordre d'arrivée, sur self.row. Une action est une fonction
+    row -> (champs à sauvegarder ou None, réponse), cf. consume_life.
+    """
+
+    def __init__(self, registry: "LivesActors", user_id: str, row: dict):
+        self.registry = registry
+        self.user_id = user_id
+        self.row = row
+        self.dirty: dict = {}
+        self.mailbox: asyncio.Queue = asyncio.Queue()
+        self.last_used = time.monotonic()
+        self.last_checkpoint = self.last_used
+        self.retired = False
+        # plus aucun message ne sera traité
+        self.closed = False
+        self.task = asyncio.create_task(self.run())
+
+    async def ask(self, action):
+        future = asyncio.get_running_loop().create_future()
+        self.mailbox.put_nowait((action, future))
+        return await future
+
+    def stop(self):
+        self.mailbox.put_nowait((_STOP, None))
+
+    def handle(self, action, future: asyncio.Future):
+        self.last_used = time.monotonic()
+        try:
+            update_lives(self.row)
+            fields, response = action(self.row)
+        except Exception as exc:
+            if not future.done():
+                future.set_exception(exc)
+            return
+
+        # même effet que refresh_user_lives, mais différé
+        self.dirty.update({k: self.row[k] for k in ("naturallives", "lastliferegenat", "lastdailybonus")})
+        self.dirty["lastactivedate"] = datetime.utcnow().isoformat()
+        if fields:
+            self.dirty.update(fields)
+            lives_broadcaster.publish(self.user_id, update_lives(self.row))
+        if not future.done():
+            future.set_result(response)
+
+    def drain(self):
+        """Traite les messages arrivés avant le retrait du registre."""
+        while not self.mailbox.empty():
+            action, future = self.mailbox.get_nowait()
+            if action is not _STOP:
+                self.handle(action, future)
+
+    async def checkpoint(self) -> bool:
+        """Sauvegarde les champs modifiés. False si Supabase a échoué."""
+        if not self.dirty:
+            return True
+        fields, self.dirty = self.dirty, {}
+        try:
+            await patch_user(self.user_id, fields)
+        except BaseException as exc:
+            # on garde les champs pour la prochaine tentative
+            self.dirty = {**fields, **self.dirty}
+            if not isinstance(exc, Exception):
+                raise
+            logger.exception("Lives checkpoint failed for %s", self.user_id)
+            return False
+        finally:
+            self.last_checkpoint = time.monotonic()
+        return True
+
+    async def flush(self):
+        """
+        Checkpoint final : réessaie pendant LIVES_ACTOR_FLUSH_SECONDS au plus.
+        Tant que l'acteur n'est pas terminé, le registre n'en recrée pas
+        (il relirait une ligne périmée). Au-delà, les champs sont loggés
+        et abandonnés pour ne pas bloquer le joueur indéfiniment.
+        """
+        deadline = time.monotonic() + LIVES_ACTOR_FLUSH_SECONDS
+        delay = 0.5
+        try:
+            while not await self.checkpoint():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.abandon()
+                    return
+                await asyncio.sleep(min(delay, remaining))
+                delay = min(delay * 2, 5.0)
+        except asyncio.CancelledError:
+            self.abandon()
+            raise
+
+    def abandon(self):
+        logger.error("Lives checkpoint abandoned for %s, lost fields: %s", self.user_id, self.dirty)
+        self.dirty = {}
+
+    async def run(self):
+        # les checkpoints ne sont pas imputés à la requête qui a créé l'acteur
+        upstream_calls.set(None)
+        try:
+            while True:
+                deadline = self.last_used + LIVES_ACTOR_IDLE_SECONDS
+                if self.dirty:
+                    deadline = min(deadline, self.last_checkpoint + LIVES_ACTOR_CHECKPOINT_SECONDS)
+                try:
+                    action, future = await asyncio.wait_for(
+                        self.mailbox.get(), timeout=max(0.0, deadline - time.monotonic())
+                    )
+                except asyncio.TimeoutError:
+                    action = None
+
+                if action is _STOP:
+                    break
+                if action is not None:
+                    self.handle(action, future)
+
+                now = time.monotonic()
+                if self.dirty and now - self.last_checkpoint >= LIVES_ACTOR_CHECKPOINT_SECONDS:
+                    await self.checkpoint()
+                if now - self.last_used >= LIVES_ACTOR_IDLE_SECONDS:
+                    self.registry.retire(self)
+                    break
+        finally:
+            try:
+                while True:
+                    self.drain()
+                    await self.flush()
+                    # pas d'await entre ce test et closed = True
+                    if self.mailbox.empty():
+                        break
+            finally:
+                self.closed = True
+                # annulation pendant le flush : on ne laisse personne attendre
+                while not self.mailbox.empty():
+                    _, future = self.mailbox.get_nowait()
+                    if future is not None and not future.done():
+                        future.cancel()
+
+
+class LivesActors:
+    """Registre LRU des acteurs actifs (au plus LIVES_ACTOR_MAX)."""
+
+    def __init__(self, max_actors: int):
+        self.max_actors = max_actors
+        self.actors: OrderedDict[str, LivesActor] = OrderedDict()
+        self.spawning: dict[str, asyncio.Future] = {}
+        # acteur en cours d'arrêt (checkpoint final) par userId
+        self.closing: dict[str, asyncio.Task] = {}
+        # routes en train d'écrire les vies hors acteur, par userId
+        self.pauses: dict[str, int] = {}
+        # incrémenté à chaque pause : une lecture commencée avant est périmée
+        self.epochs: dict[str, int] = {}
+        self.changed = asyncio.Event()
+
+    def blocked(self, user_id: str) -> bool:
+        """Aucun acteur ne doit (re)lire Supabase pour ce joueur."""
+        return user_id in self.closing or user_id in self.pauses
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def wait_until(self, predicate):
+        """Attend predicate(), au plus LIVES_ACTOR_WAIT_SECONDS, sinon 503."""
+        deadline = time.monotonic() + LIVES_ACTOR_WAIT_SECONDS
+        while not predicate():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise HTTPException(status_code=503, detail="Lives temporarily unavailable")
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout=remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    def retire(self, actor: LivesActor):
+        """Retire l'acteur du registre ; il finit ses messages puis sauvegarde."""
+        if actor.retired:
+            return
+        actor.retired = True
+        if self.actors.get(actor.user_id) is actor:
+            del self.actors[actor.user_id]
+        self.closing[actor.user_id] = actor.task
+        actor.task.add_done_callback(lambda _: self.closed(actor))
+
+    def closed(self, actor: LivesActor):
+        if self.closing.get(actor.user_id) is actor.task:
+            del self.closing[actor.user_id]
+        self.notify()
+
+    async def get(self, user_id: str) -> LivesActor | None:
+        actor = self.actors.get(user_id)
+        if actor is not None:
+            self.actors.move_to_end(user_id)
+            return actor
+
+        pending = self.spawning.get(user_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self.spawning[user_id] = future
+        try:
+            while True:
+                await self.wait_until(lambda: not self.blocked(user_id))
+                epoch = self.epochs.get(user_id, 0)
+                row = await get_user(user_id)
+                # une pause a commencé pendant la lecture : on relit après elle
+                if not self.blocked(user_id) and self.epochs.get(user_id, 0) == epoch:
+                    break
+
+            actor = LivesActor(self, user_id, row) if row else None
+            if actor is not None:
+                self.actors[user_id] = actor
+                while len(self.actors) > self.max_actors:
+                    _, oldest = self.actors.popitem(last=False)
+                    self.retire(oldest)
+                    oldest.stop()
+            future.set_result(actor)
+            return actor
+        except BaseException as exc:
+            future.set_exception(exc)
+            future.exception()
+            raise
+        finally:
+            self.spawning.pop(user_id, None)
+            if user_id not in self.pauses:
+                self.epochs.pop(user_id, None)
+
+    async def ask(self, user_id: str, action):
+        while True:
+            actor = await self.get(user_id)
+            if actor is None:
+                raise HTTPException(status_code=404, detail="User not found")
+            # acteur obtenu via un spawn concurrent puis arrêté entre-temps
+            if not actor.closed:
+                return await actor.ask(action)
+
+    async def evict(self, user_id: str):
+        """Sauvegarde et retire l'acteur du joueur s'il existe."""
+        actor = self.actors.get(user_id)
+        if actor is not None:
+            self.retire(actor)
+            actor.stop()
+        await self.wait_until(lambda: user_id not in self.closing)
+
+    @asynccontextmanager
+    async def paused(self, user_id: str):
+        """
+        Pour les routes qui écrivent les vies hors acteur : sauvegarde et
+        retire l'acteur, et empêche d'en recréer un pendant le bloc.
+        La pause est posée avant tout await.
+        """
+        if not LIVES_ACTORS_ENABLED:
+            yield
+            return
+        self.pauses[user_id] = self.pauses.get(user_id, 0) + 1
+        self.epochs[user_id] = self.epochs.get(user_id, 0) + 1
+        try:
+            await self.evict(user_id)
+            yield
+        finally:
+            self.pauses[user_id] -= 1
+            if not self.pauses[user_id]:
+                del self.pauses[user_id]
+                if user_id not in self.spawning:
+                    self.epochs.pop(user_id, None)
+            self.notify()
+
+    async def close_all(self):
+        """
+        Sauvegarde tous les acteurs en parallèle. Ceux qui ne sont pas
+        terminés après LIVES_ACTORS_SHUTDOWN_SECONDS sont annulés
+        (leurs champs non sauvegardés sont loggés par flush).
+        """
+        for actor in list(self.actors.values()):
+            self.retire(actor)
+            actor.stop()
+        tasks = list(self.closing.values())
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=LIVES_ACTORS_SHUTDOWN_SECONDS)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+lives_actors = LivesActors(LIVES_ACTOR_MAX)
+
+
+@app.on_event("shutdown")
+async def stop_lives_actors():
+    await lives_actors.close_all()
+
+
 # ============================
 #  ROUTES
 # ============================
@@ -231,7 +1167,7 @@ async def init_user(payload: UserInit):
     """
     Crée / merge un user, mais NE TOUCHE PAS aux radars.
     """
-    async with httpx.AsyncClient() as client:
+    async with supabase_client() as client:
         resp = await client.post(
             USERS_TABLE_URL,
             params={"on_conflict": "userId"},
@@ -249,6 +1185,8 @@ async def init_user(payload: UserInit):
             detail=f"Supabase initUser error: {resp.text}"
         )
 
+    username_index.set(payload.userId, payload.username)
+
     # ❌ plus de création / reset radar ici
     return {"ok": True}
 
@@ -313,7 +1251,7 @@ async def game_played(payload: StatUpdate):
 
 @app.get("/leaderboard/global")
 async def leaderboard_global():
-    async with httpx.AsyncClient() as client:
+    async with supabase_client() as client:
         resp = await client.get(
             USERS_TABLE_URL,
             params={
@@ -331,7 +1269,7 @@ async def leaderboard_global():
 
 @app.get("/leaderboard/weekly")
 async def leaderboard_weekly():
-    async with httpx.AsyncClient() as client:
+    async with supabase_client() as client:
         resp = await client.get(
             USERS_TABLE_URL,
             params={
@@ -348,85 +1286,52 @@ async def leaderboard_weekly():
 
 
 @app.post("/purchase/pack")
-async def purchase_pack(payload: PackPurchase):
-    user = await get_user(payload.userId)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    if payload.productId == "pytha.pack10":
-        amount = 10 * payload.quantity
-    elif payload.productId == "pytha.pack20":
-        amount = 20 * payload.quantity
-    else:
-        amount = 0
+async def purchase_pack(payload: PackPurchase, idempotency_key: str | None = Header(default=None)):
+    return await run_idempotent(
+        "/purchase/pack", payload, idempotency_key,
+        lambda: apply_purchase_pack(payload),
+    )
 
-    if amount <= 0:
-        return {"ok": True, "boughtLives": user.get("boughtlives") or 0}
 
-    bought = (user.get("boughtlives") or 0) + amount
+async def apply_purchase_pack(payload: PackPurchase):
+    # achat payant : toujours écrit dans Supabase avant de répondre,
+    # même en mode acteur (l'acteur est sauvegardé et retiré avant)
+    async with lives_actors.paused(payload.userId):
+        user = await get_user(payload.userId)
+        if not user:
+            raise HTTPException(status_code=404, detail="User not found")
 
-    await patch_user(payload.userId, {
-        "boughtlives": bought
-    })
+        fields, response = purchase_lives(user, payload)
+        if fields:
+            await patch_user(payload.userId, fields)
+            lives_broadcaster.publish(payload.userId, update_lives(user))
 
-    return {"ok": True, "boughtLives": bought}
+    return response
 
 
 @app.post("/consumePlay")
-async def consume_play(payload: StatUpdate):
-    user = await refresh_user_lives(payload.userId)
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+async def consume_play(payload: StatUpdate, idempotency_key: str | None = Header(default=None)):
+    return await run_idempotent(
+        "/consumePlay", payload, idempotency_key,
+        lambda: apply_consume_play(payload),
+    )
 
-    subscription = user.get("subscriptionStatus", False)
-    natural = user.get("naturallives") or 0
-    max_lives = user.get("maxnaturallives") or 3
-    bought = user.get("boughtlives") or 0
 
-    # Abonné : pas de limite de vie (on ne consomme rien)
-    if subscription:
-        return {
-            "ok": True,
-            "naturalLives": natural,
-            "maxNaturalLives": max_lives,
-            "boughtLives": bought,
-            "premiumUnlimited": True,
-        }
+async def apply_consume_play(payload: StatUpdate):
+    if LIVES_ACTORS_ENABLED:
+        return await lives_actors.ask(payload.userId, consume_life)
 
-    # On consomme d'abord une vie naturelle, sinon une vie achetée
-    last_life_regen_at = user.get("lastliferegenat")
-    now_iso = datetime.utcnow().isoformat()
+    user = await refresh_user_lives(payload.userId)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
 
-    if natural > 0:
-        natural -= 1
+    fields, response = consume_life(user)
+    if fields:
+        # Sauvegarde
+        await patch_user(payload.userId, fields)
+        lives_broadcaster.publish(payload.userId, update_lives(user))
 
-        # Si on vient de passer de plein -> pas plein, on arme un timer
-        if natural == max_lives - 1:
-            last_life_regen_at = now_iso
-
-    elif bought > 0:
-        bought -= 1
-    else:
-        raise HTTPException(status_code=400, detail="No lives left")
-
-    # Sauvegarde
-    await patch_user(
-        payload.userId,
-        {
-            "naturallives": natural,
-            "boughtlives": bought,
-            "lastliferegenat": last_life_regen_at,
-            "lastactivedate": now_iso,
-        },
-    )
-
-    return {
-        "ok": True,
-        "naturalLives": natural,
-        "maxNaturalLives": max_lives,
-        "boughtLives": bought,
-        "premiumUnlimited": False,
-    }
+    return response
 
 
 @app.post("/subscription/update")
@@ -434,13 +1339,15 @@ async def subscription(payload: SubscriptionUpdate):
     """
     Met à jour l'état de l'abonnement de l'utilisateur.
     """
-    await patch_user(
-        payload.userId,
-        {
-            "originalTransactionId": payload.originalTransactionId,
-            "subscriptionStatus": payload.isActive,
-        },
-    )
+    async with lives_actors.paused(payload.userId):
+        await patch_user(
+            payload.userId,
+            {
+                "originalTransactionId": payload.originalTransactionId,
+                "subscriptionStatus": payload.isActive,
+            },
+        )
+    await lives_broadcaster.refresh(payload.userId)
     return {"ok": True}
 
 
@@ -450,7 +1357,7 @@ async def reset_weekly():
     Remet score_weekly à 0 pour tous les users.
     Nécessite la service_role key et des policies RLS adaptées.
     """
-    async with httpx.AsyncClient() as client:
+    async with supabase_client() as client:
         resp = await client.patch(
             USERS_TABLE_URL,
             params={},  # pas de filtre => tous les users
@@ -468,7 +1375,7 @@ async def test_db():
     """
     Test simple : essaie de lire 1 user depuis Supabase.
     """
-    async with httpx.AsyncClient() as client:
+    async with supabase_client() as client:
         resp = await client.get(
             USERS_TABLE_URL,
             params={"select": "*", "limit": "1"},
@@ -501,6 +1408,45 @@ async def get_user_data(userId: str):
     }
 
 
+@app.get("/lives/stream")
+async def lives_stream(userId: str):
+    """
+    Flux SSE de l'état des vies (remplace le polling de /getUser).
+    Un event "lives" à la connexion, puis à chaque regen ou
+    changement via /consumePlay, /rewarded, /purchase/pack.
+    """
+    user = await get_user(userId)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
+    if LIVES_ACTORS_ENABLED:
+        # la ligne Supabase peut être en retard d'un checkpoint sur l'acteur
+        user.update(await lives_actors.ask(userId, lives_snapshot))
+
+    async def events():
+        # inscription dans le générateur : StreamingResponse ne le ferme pas
+        # s'il n'a jamais démarré, le finally ne serait alors jamais exécuté
+        queue = lives_broadcaster.subscribe(userId, update_lives(user))
+        try:
+            while True:
+                try:
+                    payload = await asyncio.wait_for(
+                        queue.get(), timeout=LIVES_STREAM_KEEPALIVE_SECONDS
+                    )
+                except asyncio.TimeoutError:
+                    # commentaire SSE : garde la connexion ouverte derrière les proxies
+                    yield ": keepalive\n\n"
+                    continue
+                yield f"event: lives\ndata: {json.dumps(payload)}\n\n"
+        finally:
+            lives_broadcaster.unsubscribe(userId, queue)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.post("/updateUser")
 async def update_user(payload: dict):
     user_id = payload.get("userId")
@@ -513,7 +1459,11 @@ async def update_user(payload: dict):
     if not fields:
         return {"ok": True}
 
-    await patch_user(user_id, fields)
+    async with lives_actors.paused(user_id):
+        await patch_user(user_id, fields)
+    await lives_broadcaster.refresh(user_id)
+    if "username" in fields:
+        username_index.set(user_id, fields["username"])
     return {"ok": True}
 
 
@@ -523,19 +1473,19 @@ async def check_username(username: str):
     Vérifie si un username est disponible.
     Retourne: { "available": true/false }
     """
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            USERS_TABLE_URL,
-            params={"username": f"eq.{username}", "select": "username"},
-            headers=supabase_headers(prefer_return="return=representation"),
-            timeout=10.0
-        )
+    results = await check_usernames_available([username])
+    return {"available": results[username]}
 
-    if resp.status_code != 200:
-        raise HTTPException(status_code=500, detail=f"Supabase error: {resp.text}")
 
-    data = resp.json()
-    return {"available": len(data) == 0}
+@app.post("/checkUsernames")
+async def check_usernames(payload: UsernameBatch):
+    """
+    Variante batch de /checkUsername.
+    Retourne: { "available": { "<username>": true/false, ... } }
+    """
+    if not payload.usernames:
+        return {"available": {}}
+    return {"available": await check_usernames_available(payload.usernames)}
 
 
 @app.post("/resetUser")
@@ -572,75 +1522,61 @@ async def reset_user(data: dict):
         reset_values["subscriptionStatus"] = False
         reset_values["originalTransactionId"] = None
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.patch(
-            USERS_TABLE_URL,
-            params={"userId": f"eq.{user_id}"},
-            json=reset_values,
-            headers=supabase_headers(prefer_return="return=minimal"),
-            timeout=10.0,
-        )
+    async with lives_actors.paused(user_id):
+        async with supabase_client() as client:
+            resp = await client.patch(
+                USERS_TABLE_URL,
+                params={"userId": f"eq.{user_id}"},
+                json=reset_values,
+                headers=supabase_headers(prefer_return="return=minimal"),
+                timeout=10.0,
+            )
 
     if resp.status_code not in (200, 204):
         raise HTTPException(status_code=500, detail=f"Supabase resetUser error: {resp.text}")
 
+    username_index.set(user_id, "")
+    await lives_broadcaster.refresh(user_id)
+
     return {"ok": True}
     
     
 @app.post("/rewarded")
-async def rewarded_ad(payload: StatUpdate):
+async def rewarded_ad(payload: StatUpdate, idempotency_key: str | None = Header(default=None)):
     """
     +1 vie achetée après une pub Rewarded Ad.
     Incrémente rewardedAdsTotalCount de façon cumulative (jamais remis à zéro).
     """
+    return await run_idempotent(
+        "/rewarded", payload, idempotency_key,
+        lambda: apply_rewarded_ad(payload),
+    )
+
+
+async def apply_rewarded_ad(payload: StatUpdate):
+    if LIVES_ACTORS_ENABLED:
+        return await lives_actors.ask(payload.userId, reward_life)
+
     user = await get_user(payload.userId)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
-    subscription = user.get("subscriptionStatus", False)
-    natural = user.get("naturallives") or 0
-    max_lives = user.get("maxnaturallives") or 3
-    bought = user.get("boughtlives") or 0
-
-    # compteur cumulatif
-    total_ads = user.get("rewardedAdsTotalCount") or 0
-
-    # Abonné : vies illimitées
-    if subscription:
-        return {
-            "ok": True,
-            "premiumUnlimited": True,
-            "naturalLives": natural,
-            "boughtLives": bought,
-            "rewardedAdsTotalCount": total_ads
-        }
+    fields, response = reward_life(user)
+    if fields:
+        await patch_user(payload.userId, fields)
+        lives_broadcaster.publish(payload.userId, update_lives(user))
 
-    # 🎁 Rewarded Ad = +1 vie achetée
-    bought += 1
-    total_ads += 1
+    return response
 
-    await patch_user(
-        payload.userId,
-        {
-            "boughtlives": bought,
-            "rewardedAdsTotalCount": total_ads,
-            "lastactivedate": datetime.utcnow().isoformat(),
-        }
-    )
 
-    return {
-        "ok": True,
-        "premiumUnlimited": False,
-        "naturalLives": natural,
-        "boughtLives": bought,
-        "rewardedAdsTotalCount": total_ads,
-        "maxNaturalLives": max_lives
-    }
 # ============================
 #  RADAR HELPERS
 # ============================
 
 supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
+# appels supabase-py comptés aussi (routes radar, exécutées dans le
+# threadpool qui copie le contexte de la requête)
+supabase.postgrest.session.event_hooks["request"].append(count_upstream_call_sync)
 
 def default_radar_row(user_id: str, level: int):
     """Crée une ligne radar vide pour un niveau donné."""
@@ -800,5 +1736,438 @@ def radar_reset(payload: dict):
     return {"ok": True}
 
 
+# ============================
+#  RADAR PERCENTILES
+# ============================
+RADAR_AXES = (
+    "score", "precision_value", "speed",
+    "draw", "derivative", "canonical", "rightpart", "guess",
+)
+RADAR_PERCENTILES_REFRESH_SECONDS = float(os.getenv("RADAR_PERCENTILES_REFRESH_SECONDS", "300"))
+RADAR_PERCENTILES_PAGE_SIZE = 1000
+# updatedat est posé par l'app avant le commit (et l'horloge peut varier
+# entre instances) : on relit toujours cette marge sous le watermark...
+RADAR_PERCENTILES_SAFETY_LAG_SECONDS = float(os.getenv("RADAR_PERCENTILES_SAFETY_LAG_SECONDS", "120"))
+# ...et on recharge tout périodiquement pour rattraper le reste
+RADAR_PERCENTILES_FULL_REFRESH_SECONDS = float(os.getenv("RADAR_PERCENTILES_FULL_REFRESH_SECONDS", "3600"))
+
+
+class RadarPercentiles:
+    """
+    Copie en mémoire de user_radar + tables triées par niveau et par axe.
+    Rafraîchie périodiquement : seules les lignes avec updatedat >= dernier
+    updatedat vu (moins une marge) sont relues, avec un rechargement complet
+    toutes les RADAR_PERCENTILES_FULL_REFRESH_SECONDS. Les tables sont
+    reconstruites (NumPy) si une valeur a changé.
+    Un percentile est ensuite un searchsorted par axe.
+    """
+
+    def __init__(self):
+        self.rows: dict[tuple[str, int], tuple[float, ...]] = {}
+        self.watermark: str | None = None
+        self.full_loaded_at: float | None = None
+        # level -> array (len(RADAR_AXES), n_joueurs), chaque ligne triée
+        self.tables: dict[int, np.ndarray] = {}
+        self.refreshed_at: str | None = None
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def fetch_since(self, since: str | None):
+        """
+        Lit les lignes avec updatedat >= since (tout si None).
+        Retourne (lignes, plus grand updatedat lu).
+        """
+        rows_by_key: dict[tuple[str, int], tuple[float, ...]] = {}
+        watermark = since
+        # lignes déjà lues portant exactement le timestamp du watermark
+        skip = 0
+        async with supabase_client() as client:
+            while True:
+                params = {
+                    "select": "userId,level,updatedat," + ",".join(RADAR_AXES),
+                    "order": "updatedat.asc.nullsfirst,userId.asc,level.asc",
+                    "limit": str(RADAR_PERCENTILES_PAGE_SIZE),
+                }
+                if watermark is not None:
+                    params["updatedat"] = f"gte.{watermark}"
+                if skip:
+                    params["offset"] = str(skip)
+                resp = await client.get(
+                    RADAR_TABLE_URL,
+                    params=params,
+                    headers=supabase_headers(prefer_return="return=representation"),
+                    timeout=20.0,
+                )
+                if resp.status_code != 200:
+                    raise HTTPException(status_code=500, detail=f"Supabase radar percentiles error: {resp.text}")
+
+                rows = resp.json()
+                for r in rows:
+                    rows_by_key[(r["userId"], r["level"])] = tuple(
+                        float(r.get(axis) or 0) for axis in RADAR_AXES
+                    )
+                if not rows:
+                    break
+
+                last = rows[-1]["updatedat"]
+                same = sum(1 for r in rows if r["updatedat"] == last)
+                skip = skip + same if last == watermark else same
+                watermark = last
+                if len(rows) < RADAR_PERCENTILES_PAGE_SIZE:
+                    break
+
+        return rows_by_key, watermark
+
+    @staticmethod
+    def build_tables(rows: dict[tuple[str, int], tuple[float, ...]]) -> dict[int, np.ndarray]:
+        by_level: dict[int, list[tuple[float, ...]]] = {}
+        for (_, level), values in rows.items():
+            by_level.setdefault(level, []).append(values)
+        return {
+            level: np.sort(np.asarray(values, dtype=np.float64).T, axis=1)
+            for level, values in by_level.items()
+        }
+
+    def since(self) -> str | None:
+        if self.watermark is None:
+            return None
+        lagged = datetime.fromisoformat(self.watermark) - timedelta(seconds=RADAR_PERCENTILES_SAFETY_LAG_SECONDS)
+        return lagged.isoformat()
+
+    async def refresh(self):
+        full = (
+            self.full_loaded_at is None
+            or time.monotonic() - self.full_loaded_at >= RADAR_PERCENTILES_FULL_REFRESH_SECONDS
+        )
+        if full:
+            started = time.monotonic()
+            rows, watermark = await self.fetch_since(None)
+            changed = rows != self.rows
+            self.rows = rows
+            self.full_loaded_at = started
+        else:
+            rows, watermark = await self.fetch_since(self.since())
+            changed = any(self.rows.get(key) != values for key, values in rows.items())
+            self.rows.update(rows)
+
+        if watermark is not None and (
+            self.watermark is None or parse_ts(watermark) > parse_ts(self.watermark)
+        ):
+            self.watermark = watermark
+
+        if changed or self.refreshed_at is None:
+            self.tables = await asyncio.to_thread(self.build_tables, dict(self.rows))
+        self.refreshed_at = datetime.now(timezone.utc).isoformat()
+
+    async def run(self):
+        while True:
+            try:
+                await self.refresh()
+            except Exception:
+                logger.exception("Radar percentiles refresh failed")
+            await asyncio.sleep(RADAR_PERCENTILES_REFRESH_SECONDS)
+
+    def percentiles(self, user_id: str) -> list[dict]:
+        """
+        Percentile (0-100) de chaque axe pour chaque niveau du joueur,
+        calculé sur les valeurs du dernier rafraîchissement.
+        Les ex-aequo comptent pour moitié.
+        """
+        levels = []
+        for level, table in sorted(self.tables.items()):
+            values = self.rows.get((user_id, level))
+            if values is None:
+                continue
+            n = table.shape[1]
+            percentiles = {}
+            for i, axis in enumerate(RADAR_AXES):
+                below = np.searchsorted(table[i], values[i], side="left")
+                upto = np.searchsorted(table[i], values[i], side="right")
+                percentiles[axis] = round(float(below + upto) * 50.0 / n, 2)
+            levels.append({"level": level, "players": n, "percentiles": percentiles})
+        return levels
+
+
+radar_percentiles = RadarPercentiles()
+
+
+@app.on_event("startup")
+async def start_radar_percentiles():
+    radar_percentiles.start()
+
+
+@router.get("/radar/percentiles")
+async def radar_percentiles_get(userId: str):
+    """
+    Position du joueur par rapport à tous les joueurs, par niveau et par axe.
+    """
+    if radar_percentiles.refreshed_at is None:
+        raise HTTPException(status_code=503, detail="Radar percentiles not ready")
+
+    return {
+        "userId": userId,
+        "refreshedAt": radar_percentiles.refreshed_at,
+        "levels": radar_percentiles.percentiles(userId),
+    }
+
+
+# ============================
+#  EXPORT NDJSON (admin)
+# ============================
+EXPORT_ADMIN_TOKEN = os.getenv("EXPORT_ADMIN_TOKEN")
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+COLUMN_NAME_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+def check_export_token(token: str | None):
+    """Export désactivé tant que EXPORT_ADMIN_TOKEN n'est pas défini."""
+    if not EXPORT_ADMIN_TOKEN or not hmac.compare_digest((token or "").encode(), EXPORT_ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+async def export_ndjson(table_url: str, keys: tuple[str, ...], columns: str | None,
+                        since_column: str, since: str | None) -> StreamingResponse:
+    """
+    Stream NDJSON d'une table, une page de EXPORT_PAGE_SIZE lignes à la fois
+    (keyset sur `keys`) : la mémoire reste constante quelle que soit la taille.
+    La première page est lue avant d'envoyer le 200, pour que les erreurs
+    (colonne inconnue, since invalide, Supabase) aient un vrai code HTTP.
+    Une erreur sur une page suivante termine le flux par {"error": ...}.
+    """
+    wanted = None
+    select = "*"
+    if columns:
+        wanted = [c.strip() for c in columns.split(",") if c.strip()]
+        invalid = [c for c in wanted if not COLUMN_NAME_RE.match(c)]
+        if invalid:
+            raise HTTPException(status_code=400, detail=f"Invalid columns: {', '.join(invalid)}")
+        # les clés du keyset doivent être lues même si non demandées
+        select = ",".join(dict.fromkeys([*wanted, *keys]))
+
+    filters = {since_column: f"gte.{since}"} if since else None
+
+    pages = iter_keyset_pages(table_url, select, keys, filters, EXPORT_PAGE_SIZE)
+    try:
+        first = await anext(pages, None)
+    except BaseException:
+        await pages.aclose()
+        raise
+
+    def ndjson(rows: list[dict]) -> str:
+        if wanted is not None:
+            rows = [{c: r.get(c) for c in wanted} for r in rows]
+        return "".join(json.dumps(r, default=str) + "\n" for r in rows)
+
+    async def lines():
+        try:
+            if first is None:
+                return
+            yield ndjson(first)
+            async for rows in pages:
+                yield ndjson(rows)
+        except Exception as exc:
+            logger.exception("Export %s interrupted", table_url)
+            detail = exc.detail if isinstance(exc, HTTPException) else str(exc)
+            yield json.dumps({"error": detail}) + "\n"
+        finally:
+            await pages.aclose()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/export/users")
+async def export_users(
+    columns: str | None = None,
+    since: str | None = None,
+    x_admin_token: str | None = Header(default=None),
+):
+    """
+    Export NDJSON de la table users.
+    columns : liste séparée par des virgules (défaut : toutes)
+    since   : lastactivedate minimum (ISO) pour un export incrémental
+    """
+    check_export_token(x_admin_token)
+    return await export_ndjson(USERS_TABLE_URL, ("userId",), columns, "lastactivedate", since)
+
+
+@app.get("/export/radar")
+async def export_radar(
+    columns: str | None = None,
+    since: str | None = None,
+    x_admin_token: str | None = Header(default=None),
+):
+    """
+    Export NDJSON de la table user_radar.
+    columns : liste séparée par des virgules (défaut : toutes)
+    since   : updatedat minimum (ISO) pour un export incrémental
+    """
+    check_export_token(x_admin_token)
+    return await export_ndjson(RADAR_TABLE_URL, ("userId", "level"), columns, "updatedat", since)
+
+
+# ============================
+#  TRAFFIC CAPTURE (optionnel)
+# ============================
+# TRAFFIC_CAPTURE_PATH=traffic.jsonl : échantillonne les requêtes dans un
+# fichier JSONL tournant, rejouable avec replay.py.
+# UPSTREAM_CALLS_HEADER=1 : ajoute X-Upstream-Calls (nb d'appels Supabase)
+# à chaque réponse ; à activer sur l'instance locale visée par replay.py.
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH")
+TRAFFIC_CAPTURE_SAMPLE_RATE = float(os.getenv("TRAFFIC_CAPTURE_SAMPLE_RATE", "1.0"))
+TRAFFIC_CAPTURE_MAX_BYTES = int(os.getenv("TRAFFIC_CAPTURE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRAFFIC_CAPTURE_BACKUPS = int(os.getenv("TRAFFIC_CAPTURE_BACKUPS", "5"))
+TRAFFIC_CAPTURE_SALT = os.getenv("TRAFFIC_CAPTURE_SALT", "")
+TRAFFIC_CAPTURE_MAX_BODY = 64 * 1024
+# réponses en streaming : durée = durée de connexion, rien à rejouer
+TRAFFIC_CAPTURE_SKIP_PREFIXES = ("/lives/stream", "/export/")
+UPSTREAM_CALLS_HEADER = os.getenv("UPSTREAM_CALLS_HEADER", "0") == "1"
+
+# sans sel, un hash de username se retrouve avec une simple liste de mots
+if TRAFFIC_CAPTURE_PATH and not TRAFFIC_CAPTURE_SALT:
+    raise RuntimeError("TRAFFIC_CAPTURE_SALT doit être définie (non vide) quand TRAFFIC_CAPTURE_PATH l'est.")
+
+
+# champs texte gardés en clair (non identifiants, utiles au rejeu) ;
+# toute autre chaîne (userId, username, originalTransactionId, champs
+# libres de /updateUser...) est hachée. Nombres et booléens restent en clair.
+TRAFFIC_CAPTURE_CLEAR_FIELDS = frozenset({
+    "productId", "lastactivedate", "updatedat", "resetSubscriptionData",
+})
+
+
+def hash_value(value) -> str:
+    """Hash salé et stable : un même userId / username donne la même valeur au rejeu."""
+    digest = hashlib.sha256(f"{TRAFFIC_CAPTURE_SALT}{value}".encode()).hexdigest()
+    return f"h_{digest[:16]}"
+
+
+def anonymize_value(key: str | None, value):
+    if isinstance(value, dict):
+        return {k: anonymize_value(k, v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [anonymize_value(key, v) for v in value]
+    if isinstance(value, str) and value and key not in TRAFFIC_CAPTURE_CLEAR_FIELDS:
+        return hash_value(value)
+    return value
+
+
+def anonymize_body(body: bytes):
+    """Body JSON anonymisé ; None si absent, illisible ou trop gros."""
+    if not body or len(body) > TRAFFIC_CAPTURE_MAX_BODY:
+        return None
+    try:
+        data = json.loads(body)
+    except ValueError:
+        return None
+    return anonymize_value(None, data)
+
+
+def anonymize_query(query: bytes) -> str:
+    params = [
+        (k, anonymize_value(k, v))
+        for k, v in parse_qsl(query.decode("latin-1"), keep_blank_values=True)
+    ]
+    return urlencode(params)
+
+
+def traffic_logger() -> logging.Logger | None:
+    """
+    Logger dédié vers un fichier tournant. L'écriture disque se fait dans
+    le thread d'un QueueListener, jamais dans la boucle asyncio.
+    """
+    if not TRAFFIC_CAPTURE_PATH:
+        return None
+    handler = logging.handlers.RotatingFileHandler(
+        TRAFFIC_CAPTURE_PATH,
+        maxBytes=TRAFFIC_CAPTURE_MAX_BYTES,
+        backupCount=TRAFFIC_CAPTURE_BACKUPS,
+        encoding="utf-8",
+    )
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    logging.handlers.QueueListener(records, handler).start()
+
+    capture = logging.getLogger("pytha.traffic")
+    capture.setLevel(logging.INFO)
+    capture.propagate = False
+    capture.addHandler(logging.handlers.QueueHandler(records))
+    return capture
+
+
+class TrafficCapture:
+    """Middleware ASGI : compte les appels Supabase et échantillonne les requêtes."""
+
+    def __init__(self, app, capture: logging.Logger | None):
+        self.app = app
+        self.capture = capture
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        counter = [0]
+        token = upstream_calls.set(counter)
+        path = scope["path"]
+        # rejoué tel quel, sinon les retries seraient appliqués deux fois
+        idempotency_key = next(
+            (v.decode("latin-1") for k, v in scope.get("headers", []) if k == b"idempotency-key"),
+            None,
+        )
+        sampled = (
+            self.capture is not None
+            and not path.startswith(TRAFFIC_CAPTURE_SKIP_PREFIXES)
+            and random.random() < TRAFFIC_CAPTURE_SAMPLE_RATE
+        )
+        body = bytearray()
+        status = None
+        started_at = time.time()
+        start = time.perf_counter()
+
+        async def receive_body():
+            message = await receive()
+            if message["type"] == "http.request":
+                body.extend(message.get("body", b""))
+            return message
+
+        async def send_counted(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if UPSTREAM_CALLS_HEADER:
+                    message = {
+                        **message,
+                        "headers": [
+                            *message.get("headers", []),
+                            (b"x-upstream-calls", str(counter[0]).encode()),
+                        ],
+                    }
+            await send(message)
+
+        try:
+            await self.app(scope, receive_body if sampled else receive, send_counted)
+        finally:
+            upstream_calls.reset(token)
+            if sampled:
+                self.capture.info(json.dumps({
+                    "ts": round(started_at, 3),
+                    "method": scope["method"],
+                    "path": path,
+                    "query": anonymize_query(scope.get("query_string", b"")),
+                    "body": anonymize_body(bytes(body)),
+                    "idempotencyKey": idempotency_key,
+                    "status": status,
+                    "ms": round((time.perf_counter() - start) * 1000, 2),
+                    "upstream": counter[0],
+                }, separators=(",", ":")))
+
+
+if TRAFFIC_CAPTURE_PATH or UPSTREAM_CALLS_HEADER:
+    app.add_middleware(TrafficCapture, capture=traffic_logger())
+
+
 # IMPORTANT – add routes
 app.include_router(router)
@@ -0,0 +1,140 @@
+"""
+Rejoue un trafic capturé (TRAFFIC_CAPTURE_PATH, cf. main.py) contre une
+instance de l'API, et affiche par route la distribution des latences et le
+nombre d'appels Supabase par requête.
+
+L'instance visée doit tourner avec UPSTREAM_CALLS_HEADER=1 et pointer sur
+un backend local (SUPABASE_URL). Les userId, usernames et autres chaînes
+identifiantes capturés sont hachés : le backend local doit contenir ces
+ids (ex: rejouer aussi les /initUser). L'Idempotency-Key d'origine est
+renvoyée, pour que les retries ne soient pas appliqués deux fois.
+
+    python replay.py traffic.jsonl traffic.jsonl.1 --target http://127.0.0.1:8000 --speed 2
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+
+def load_records(paths: list[str]) -> list[dict]:
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    records.sort(key=lambda r: r["ts"])
+    return records
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def replay(records: list[dict], target: str, speed: float, concurrency: int) -> dict:
+    """
+    Envoie chaque requête à son instant d'origine divisé par `speed`
+    (speed=0 : au plus vite, limité par `concurrency`).
+    """
+    results: dict[str, list[dict]] = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    t0 = records[0]["ts"] if records else 0.0
+
+    async with httpx.AsyncClient(base_url=target, timeout=30.0) as client:
+        start = time.perf_counter()
+
+        async def send(record: dict):
+            if speed > 0:
+                delay = (record["ts"] - t0) / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            async with semaphore:
+                url = record["path"] + (f"?{record['query']}" if record.get("query") else "")
+                kwargs = {"json": record["body"]} if record.get("body") is not None else {}
+                if record.get("idempotencyKey"):
+                    kwargs["headers"] = {"Idempotency-Key": record["idempotencyKey"]}
+                sent_at = time.perf_counter()
+                try:
+                    resp = await client.request(record["method"], url, **kwargs)
+                    status = resp.status_code
+                    upstream = resp.headers.get("x-upstream-calls")
+                except httpx.HTTPError:
+                    status, upstream = None, None
+                ms = (time.perf_counter() - sent_at) * 1000
+
+            route = f"{record['method']} {record['path']}"
+            results.setdefault(route, []).append({
+                "ms": ms,
+                "status": status,
+                "upstream": int(upstream) if upstream is not None else None,
+                "orig_ms": record.get("ms"),
+                "orig_upstream": record.get("upstream"),
+            })
+
+        await asyncio.gather(*(send(r) for r in records))
+
+    return results
+
+
+def summarize(results: dict[str, list[dict]]) -> dict:
+    report = {}
+    for route, rows in sorted(results.items()):
+        latencies = sorted(r["ms"] for r in rows)
+        orig = sorted(r["orig_ms"] for r in rows if r["orig_ms"] is not None)
+        upstream = [r["upstream"] for r in rows if r["upstream"] is not None]
+        orig_upstream = [r["orig_upstream"] for r in rows if r["orig_upstream"] is not None]
+        report[route] = {
+            "count": len(rows),
+            "errors": sum(1 for r in rows if r["status"] is None or r["status"] >= 500),
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "max_ms": round(latencies[-1], 2) if latencies else 0.0,
+            "orig_p50_ms": round(percentile(orig, 50), 2),
+            "upstream_per_req": round(sum(upstream) / len(upstream), 2) if upstream else None,
+            "orig_upstream_per_req": round(sum(orig_upstream) / len(orig_upstream), 2) if orig_upstream else None,
+        }
+    return report
+
+
+def print_report(report: dict):
+    header = f"{'route':<32} {'n':>6} {'err':>5} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'orig50':>8} {'up/req':>7} {'orig':>6}"
+    print(header)
+    print("-" * len(header))
+    for route, r in report.items():
+        up = "-" if r["upstream_per_req"] is None else r["upstream_per_req"]
+        orig_up = "-" if r["orig_upstream_per_req"] is None else r["orig_upstream_per_req"]
+        print(
+            f"{route:<32} {r['count']:>6} {r['errors']:>5} {r['p50_ms']:>8} {r['p95_ms']:>8} "
+            f"{r['p99_ms']:>8} {r['max_ms']:>8} {r['orig_p50_ms']:>8} {up:>7} {orig_up:>6}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rejoue un trafic capturé contre l'API.")
+    parser.add_argument("logs", nargs="+", help="fichiers JSONL capturés (rotations incluses)")
+    parser.add_argument("--target", default="http://127.0.0.1:8000", help="URL de l'API visée")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="facteur de vitesse (1 = temps réel, 0 = au plus vite)")
+    parser.add_argument("--concurrency", type=int, default=64, help="requêtes simultanées max")
+    parser.add_argument("--json", action="store_true", help="rapport en JSON")
+    args = parser.parse_args()
+
+    records = load_records(args.logs)
+    results = asyncio.run(replay(records, args.target, args.speed, args.concurrency))
+    report = summarize(results)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Fixtures communes : un faux Supabase (httpx.MockTransport) branché à la
+place de supabase_client(), et des registres neufs pour chaque test.
+"""
+import asyncio
+import json
+import os
+import sys
+from datetime import datetime
+
+# lu à l'import de main.py
+os.environ.update({
+    "SUPABASE_URL": "http://supabase.test",
+    "SUPABASE_SERVICE_ROLE_KEY": "test-key",
+    "LIVES_ACTORS": "1",
+    # pas de checkpoint périodique : seules les évictions sauvegardent
+    "LIVES_ACTOR_CHECKPOINT_SECONDS": "3600",
+    "LIVES_ACTOR_IDLE_SECONDS": "3600",
+    "LIVES_ACTOR_FLUSH_SECONDS": "5",
+    "LIVES_ACTOR_WAIT_SECONDS": "5",
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+import pytest
+
+import main
+
+
+class FakeSupabase:
+    """
+    Table users en mémoire. Une lecture prend sa copie de la ligne dès
+    l'arrivée de la requête, puis attend get_gate s'il est posé : on peut
+    ainsi tenir une lecture "en vol" pendant qu'une autre route écrit.
+    """
+
+    def __init__(self):
+        self.users: dict[str, dict] = {}
+        self.patches: list[tuple[str, dict]] = []
+        self.get_gate: asyncio.Event | None = None
+        self.patch_failures = 0
+
+    def add_user(self, user_id: str, **fields) -> dict:
+        row = {
+            "userId": user_id,
+            "naturallives": 3,
+            "maxnaturallives": 3,
+            "boughtlives": 0,
+            "lastdailybonus": datetime.utcnow().date().isoformat(),
+            **fields,
+        }
+        self.users[user_id] = row
+        return row
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        user_id = request.url.params.get("userId", "").removeprefix("eq.")
+        if request.method == "GET":
+            row = self.users.get(user_id)
+            rows = [dict(row)] if row else []
+            if self.get_gate is not None:
+                await self.get_gate.wait()
+            return httpx.Response(200, json=rows)
+        if request.method == "PATCH":
+            if self.patch_failures:
+                self.patch_failures -= 1
+                return httpx.Response(503, text="unavailable")
+            fields = json.loads(request.content)
+            self.patches.append((user_id, fields))
+            self.users[user_id].update(fields)
+            return httpx.Response(204)
+        return httpx.Response(405)
+
+
+@pytest.fixture
+def supabase(monkeypatch) -> FakeSupabase:
+    fake = FakeSupabase()
+
+    def client() -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            transport=httpx.MockTransport(fake.handler),
+            event_hooks={"request": [main.count_upstream_call]},
+        )
+
+    monkeypatch.setattr(main, "supabase_client", client)
+    monkeypatch.setattr(main, "lives_actors", main.LivesActors(main.LIVES_ACTOR_MAX))
+    monkeypatch.setattr(main, "lives_broadcaster", main.LivesBroadcaster())
+    monkeypatch.setattr(main, "idempotency_cache", main.IdempotencyCache(60, 100))
+    return fake
+
+
+@pytest.fixture
+def run():
+    """
+    Exécute un scénario async puis arrête les acteurs qu'il a créés.
+    Un scénario bloqué (course non gérée) échoue au lieu de pendre.
+    """
+
+    def runner(scenario):
+        async def wrapper():
+            try:
+                return await asyncio.wait_for(scenario, timeout=10)
+            finally:
+                await main.lives_actors.close_all()
+
+        return asyncio.run(wrapper())
+
+    return runner
+
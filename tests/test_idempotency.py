@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import main
+from main import PackPurchase
+
+
+async def settle():
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+
+def pack(quantity: int = 1) -> PackPurchase:
+    return PackPurchase(userId="u1", productId="pytha.pack10", quantity=quantity)
+
+
+def test_duplicate_key_in_flight_is_applied_once(supabase, run):
+    supabase.add_user("u1")
+
+    async def scenario():
+        supabase.get_gate = asyncio.Event()
+        first = asyncio.create_task(main.purchase_pack(pack(), idempotency_key="k1"))
+        await settle()
+        retry = asyncio.create_task(main.purchase_pack(pack(), idempotency_key="k1"))
+        await settle()
+        supabase.get_gate.set()
+        return await first, await retry
+
+    first, retry = run(scenario())
+
+    assert first == retry == {"ok": True, "boughtLives": 10}
+    assert len(supabase.patches) == 1
+    assert supabase.users["u1"]["boughtlives"] == 10
+
+
+def test_retry_after_completion_returns_stored_response(supabase, run):
+    supabase.add_user("u1")
+
+    async def scenario():
+        first = await main.purchase_pack(pack(), idempotency_key="k1")
+        retry = await main.purchase_pack(pack(), idempotency_key="k1")
+        return first, retry
+
+    first, retry = run(scenario())
+
+    assert first == retry
+    assert len(supabase.patches) == 1
+
+
+def test_key_reused_with_different_body_is_rejected(supabase, run):
+    supabase.add_user("u1")
+
+    async def scenario():
+        await main.purchase_pack(pack(1), idempotency_key="k1")
+        await main.purchase_pack(pack(2), idempotency_key="k1")
+
+    with pytest.raises(HTTPException) as exc:
+        run(scenario())
+
+    assert exc.value.status_code == 422
+    assert supabase.users["u1"]["boughtlives"] == 10
+
+
+def test_key_reused_with_different_body_while_in_flight_is_rejected(supabase, run):
+    supabase.add_user("u1")
+
+    async def scenario():
+        supabase.get_gate = asyncio.Event()
+        first = asyncio.create_task(main.purchase_pack(pack(1), idempotency_key="k1"))
+        await settle()
+        with pytest.raises(HTTPException) as exc:
+            await main.purchase_pack(pack(2), idempotency_key="k1")
+        supabase.get_gate.set()
+        await first
+        return exc.value
+
+    assert run(scenario()).status_code == 422
+    assert supabase.users["u1"]["boughtlives"] == 10
+
+
+def test_cancelled_original_is_replayed_by_waiting_retry(supabase, run):
+    supabase.add_user("u1")
+
+    async def scenario():
+        supabase.get_gate = asyncio.Event()
+        first = asyncio.create_task(main.purchase_pack(pack(), idempotency_key="k1"))
+        await settle()
+        retry = asyncio.create_task(main.purchase_pack(pack(), idempotency_key="k1"))
+        await settle()
+        first.cancel()
+        await settle()
+        supabase.get_gate.set()
+        return await retry
+
+    assert run(scenario()) == {"ok": True, "boughtLives": 10}
+    assert len(supabase.patches) == 1
+
+
+def test_errors_are_not_cached(supabase, run):
+    supabase.add_user("u1")
+    supabase.patch_failures = 1
+
+    async def scenario():
+        with pytest.raises(HTTPException):
+            await main.purchase_pack(pack(), idempotency_key="k1")
+        return await main.purchase_pack(pack(), idempotency_key="k1")
+
+    assert run(scenario()) == {"ok": True, "boughtLives": 10}
+    assert len(supabase.patches) == 1
@@ -0,0 +1,156 @@
+# les routes sont appelées via apply_* : appelées directement, leur
+# paramètre Idempotency-Key vaudrait Header(...) au lieu de None
+
+import asyncio
+
+import main
+from main import StatUpdate
+
+
+async def settle():
+    for _ in range(20):
+        await asyncio.sleep(0)
+
+
+def test_pause_during_spawn_read_forces_a_reread(supabase, run):
+    # la lecture de l'acteur part avant /updateUser et revient après :
+    # l'acteur ne doit pas être créé avec cette ligne périmée
+    supabase.add_user("u1", naturallives=3, boughtlives=5)
+
+    async def scenario():
+        supabase.get_gate = asyncio.Event()
+        consume = asyncio.create_task(main.apply_consume_play(StatUpdate(userId="u1")))
+        await settle()
+        update = asyncio.create_task(
+            main.update_user({"userId": "u1", "naturallives": 0, "boughtlives": 1})
+        )
+        while not supabase.patches:
+            await asyncio.sleep(0)
+        supabase.get_gate.set()
+        await update
+        return await consume
+
+    response = run(scenario())
+
+    assert response["naturalLives"] == 0
+    assert response["boughtLives"] == 0
+    assert supabase.users["u1"]["naturallives"] == 0
+    assert supabase.users["u1"]["boughtlives"] == 0
+
+
+def test_pause_flushes_actor_before_writing(supabase, run):
+    supabase.add_user("u1", naturallives=3, boughtlives=0)
+
+    async def scenario():
+        await main.apply_consume_play(StatUpdate(userId="u1"))
+        assert supabase.patches == []
+        return await main.apply_purchase_pack(
+            main.PackPurchase(userId="u1", productId="pytha.pack10", quantity=1)
+        )
+
+    run(scenario())
+
+    assert supabase.users["u1"]["naturallives"] == 2
+    assert supabase.users["u1"]["boughtlives"] == 10
+
+
+def test_eviction_flushes_dirty_fields(supabase, run, monkeypatch):
+    monkeypatch.setattr(main, "lives_actors", main.LivesActors(1))
+    supabase.add_user("u1")
+    supabase.add_user("u2")
+    # le checkpoint final réessaie après un échec
+    supabase.patch_failures = 1
+
+    async def scenario():
+        await main.apply_consume_play(StatUpdate(userId="u1"))
+        await main.apply_consume_play(StatUpdate(userId="u1"))
+        assert supabase.patches == []
+        # LRU de taille 1 : u2 évince u1
+        await main.apply_consume_play(StatUpdate(userId="u2"))
+        await main.lives_actors.wait_until(lambda: "u1" not in main.lives_actors.closing)
+
+    run(scenario())
+
+    assert [user_id for user_id, _ in supabase.patches][:1] == ["u1"]
+    assert supabase.users["u1"]["naturallives"] == 1
+
+
+def test_failed_final_flush_releases_the_user(supabase, run, monkeypatch):
+    monkeypatch.setattr(main, "LIVES_ACTOR_FLUSH_SECONDS", 0.2)
+    supabase.add_user("u1")
+
+    async def scenario():
+        await main.apply_consume_play(StatUpdate(userId="u1"))
+        supabase.patch_failures = 1000
+        await main.lives_actors.evict("u1")
+        assert "u1" not in main.lives_actors.closing
+        supabase.patch_failures = 0
+        # nouvel acteur relu depuis Supabase : la vie non sauvegardée est perdue
+        return await main.apply_consume_play(StatUpdate(userId="u1"))
+
+    assert run(scenario())["naturalLives"] == 2
+
+
+def test_ask_on_closing_actor_retries_on_a_new_one(supabase, run):
+    supabase.add_user("u1")
+
+    async def scenario():
+        registry = main.lives_actors
+        stale = await registry.get("u1")
+        await registry.evict("u1")
+        assert stale.closed
+
+        # get() rend l'acteur fermé une fois, comme un spawn concurrent
+        # dont l'acteur s'est arrêté avant l'ask
+        real_get = registry.get
+        calls = []
+
+        async def get(user_id):
+            calls.append(user_id)
+            return stale if len(calls) == 1 else await real_get(user_id)
+
+        registry.get = get
+        response = await registry.ask("u1", main.consume_life)
+        actor = registry.actors.get("u1")
+        assert actor is not None and actor is not stale and not actor.closed
+        return response, calls
+
+    response, calls = run(scenario())
+
+    assert len(calls) == 2
+    assert response["naturalLives"] == 2
+    assert supabase.users["u1"]["naturallives"] == 2
+
+
+def test_messages_queued_behind_stop_are_handled_and_flushed(supabase, run):
+    supabase.add_user("u1")
+
+    async def scenario():
+        actor = await main.lives_actors.get("u1")
+        main.lives_actors.retire(actor)
+        actor.stop()
+        response = await actor.ask(main.consume_life)
+        await main.lives_actors.wait_until(lambda: "u1" not in main.lives_actors.closing)
+        return response, actor
+
+    response, actor = run(scenario())
+
+    assert response["naturalLives"] == 2
+    assert actor.closed
+    assert supabase.users["u1"]["naturallives"] == 2
+
+
+def test_close_all_flushes_every_actor(supabase, run):
+    for user_id in ("u1", "u2", "u3"):
+        supabase.add_user(user_id)
+
+    async def scenario():
+        for user_id in ("u1", "u2", "u3"):
+            await main.apply_consume_play(StatUpdate(userId=user_id))
+        await main.lives_actors.close_all()
+        return main.lives_actors
+
+    registry = run(scenario())
+
+    assert not registry.actors and not registry.closing
+    assert all(row["naturallives"] == 2 for row in supabase.users.values())